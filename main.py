@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
-# !pip install playwright reportlab pillow nest_asyncio
+# !pip install playwright reportlab pillow svglib
 
 # !playwright install chromium
 
-# pip install pandas openpyxl
+# pip install openpyxl
+
+import time
+
+# Measured before any other import to report the startup time
+_STARTUP_BEGIN = time.perf_counter()
 
 import os
+import argparse
 import asyncio
-from playwright.async_api import async_playwright
-from reportlab.lib.pagesizes import A4, landscape
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import inch
-import pandas as pd
+import concurrent.futures
+import copy
+import hashlib
+import json
+import shutil
+import threading
+import uuid
+import traceback
 import re
 import smtplib
 from email.mime.multipart import MIMEMultipart
@@ -20,30 +29,363 @@ from email.mime.application import MIMEApplication
 from email.mime.base import MIMEBase
 from email import encoders
 from pathlib import Path
-import openpyxl
-import glob
+from collections import deque
+from contextlib import asynccontextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
 # import schedule
-import time
 from datetime import datetime
-from openpyxl.styles import PatternFill
-from dotenv import load_dotenv
 import locale
 
+# Heavy dependencies (playwright, reportlab, openpyxl, svglib) are imported
+# inside the functions that need them so that importing this module, listing
+# dashboards or rendering a PDF doesn't pay for the whole stack.
+
 # Define colors
-yellow_fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
-green_fill = PatternFill(start_color="00FF00", end_color="00FF00", fill_type="solid")
-red_fill = PatternFill(start_color="FF0000", end_color="FF0000", fill_type="solid")
-yellow_green_fill = PatternFill(start_color="ADFF2F", end_color="ADFF2F", fill_type="solid")  # Yellow-greenish
+YELLOW = "FFFF00"
+GREEN = "00FF00"
+RED = "FF0000"
+YELLOW_GREEN = "ADFF2F"  # Yellow-greenish
+
+
+def solid_fill(color):
+    """Return a solid openpyxl fill of the given color."""
+    from openpyxl.styles import PatternFill
+    return PatternFill(start_color=color, end_color=color, fill_type="solid")
+
+def load_svg_drawing(svg_path):
+    """Convert an SVG file to a ReportLab drawing, or return None if svglib is missing or the SVG can't be parsed."""
+    try:
+        from svglib.svglib import svg2rlg
+    except ImportError:
+        return None
+    try:
+        drawing = svg2rlg(svg_path)
+    except Exception as e:
+        print(f"Could not parse SVG {svg_path}: {str(e)}")
+        return None
+    if drawing is None or not drawing.width or not drawing.height:
+        return None
+    return drawing
+
+
+# Checkpoint manifest written in each dashboard output directory
+MANIFEST_FILENAME = "manifest.json"
+
+
+def new_manifest(dashboard_url):
+    """Return an empty checkpoint manifest for today's run of a dashboard."""
+    return {
+        'date': datetime.now().strftime('%Y-%m-%d'),
+        'dashboard_url': dashboard_url,
+        'card_count': None,
+        'cards': {},
+        'pdf': None,
+        'email_sent': False,
+        'email_missing_cards': [],
+        'error': None,
+    }
+
+
+def load_manifest(output_dir, dashboard_url):
+    """Load the checkpoint manifest of a dashboard, starting fresh if it is missing, unreadable or from another day."""
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return new_manifest(dashboard_url)
+
+    fresh = new_manifest(dashboard_url)
+    if manifest.get('date') != fresh['date'] or manifest.get('dashboard_url') != dashboard_url:
+        print(f"Ignoring stale checkpoint manifest in {output_dir}")
+        return fresh
+    return {**fresh, **manifest}
+
+
+def save_manifest(output_dir, manifest):
+    """Atomically write the checkpoint manifest of a dashboard."""
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def manifest_card_lists(manifest):
+    """Return (card_paths, is_table_card) in card order; failed cards have no screenshot path."""
+    card_paths = []
+    is_table_card = []
+    for card_id in range(1, (manifest['card_count'] or 0) + 1):
+        entry = manifest['cards'].get(str(card_id), {})
+        done = manifest_card_done(entry)
+        card_paths.append((entry.get('svg') or entry.get('screenshot')) if done else None)
+        is_table_card.append(bool(entry.get('is_table')) if done else False)
+    return card_paths, is_table_card
+
+
+def manifest_card_done(entry):
+    """Whether a card of the manifest is completed and its files are still on disk.
+
+    Screenshots can live in the shared image store, which evicts files between runs.
+    """
+    if entry.get('status') != 'done':
+        return False
+    image_path = entry.get('svg') or entry.get('screenshot')
+    if not image_path or not os.path.exists(image_path):
+        return False
+    return not entry.get('xlsx') or os.path.exists(entry['xlsx'])
+
+
+def manifest_failed_cards(manifest):
+    """Return the ids of the cards that are not completed in the manifest."""
+    return [card_id for card_id in range(1, (manifest['card_count'] or 0) + 1)
+            if not manifest_card_done(manifest['cards'].get(str(card_id), {}))]
+
+
+def manifest_xlsx_files(manifest):
+    """Return the Excel files exported by completed cards that are still on disk."""
+    xlsx_files = []
+    for card_id in range(1, (manifest['card_count'] or 0) + 1):
+        xlsx_path = manifest['cards'].get(str(card_id), {}).get('xlsx')
+        if xlsx_path and os.path.exists(xlsx_path) and xlsx_path not in xlsx_files:
+            xlsx_files.append(xlsx_path)
+    return xlsx_files
+
+
+class ImageStore:
+    """Content-addressed store of card captures, shared across runs and dashboards.
+
+    Captures are stored once under the SHA-256 of their PNG bytes, and the
+    downscaled copies drawn in the PDF are kept next to them, so identical
+    cards are neither written nor resized twice. Identical images also map to
+    the same path, which ReportLab embeds only once per PDF. The least
+    recently used files are evicted when the store grows over `max_bytes`.
+    """
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, dpi=150):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.dpi = dpi  # Resolution of the images drawn in the PDF
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _touch(self, path):
+        # Mark the file as recently used for the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def add(self, png_bytes):
+        """Store a PNG capture and return its path, reusing the existing file for identical content."""
+        digest = hashlib.sha256(png_bytes).hexdigest()
+        path = os.path.join(self.cache_dir, f"{digest}.png")
+        if os.path.exists(path):
+            self._touch(path)
+            return path
+
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(png_bytes)
+        os.replace(tmp_path, path)
+        self._evict(keep=path)
+        return path
+
+    def resized(self, img_path, width, height):
+        """Return a copy of the image downscaled to fit a box of width x height points, at `dpi`."""
+        from PIL import Image
+
+        if os.path.dirname(os.path.abspath(img_path)) == os.path.abspath(self.cache_dir):
+            digest = os.path.splitext(os.path.basename(img_path))[0]
+        else:
+            with open(img_path, 'rb') as file:
+                digest = hashlib.sha256(file.read()).hexdigest()
+
+        max_width = max(1, int(width * self.dpi / 72))
+        max_height = max(1, int(height * self.dpi / 72))
+        path = os.path.join(self.cache_dir, f"{digest}_{max_width}x{max_height}.png")
+        if os.path.exists(path):
+            self._touch(path)
+            return path
+
+        with Image.open(img_path) as image:
+            if image.width <= max_width and image.height <= max_height:
+                return img_path
+            image.thumbnail((max_width, max_height), Image.LANCZOS)
+            # PDFs can be built from several threads at once, each writes its own temporary file
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            image.save(tmp_path, format='PNG', optimize=True)
+        os.replace(tmp_path, path)
+        self._evict(keep=path)
+        return path
+
+    def _evict(self, keep=None):
+        """Delete the least recently used files until the store fits in `max_bytes`."""
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith('.png'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # Evicted by another thread meanwhile
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        if total <= self.max_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        print(f"Image cache evicted down to {total / (1024 * 1024):.1f} MB")
+
+
+# Metabase endpoints that run a card query against the database
+CARD_QUERY_PATTERN = re.compile(r'/api/(dashboard/\d+/dashcard/\d+/)?card/\d+/query')
+
+
+class LoadGovernor:
+    """Limit the load put on the Metabase server.
+
+    Card query latency and errors are measured from the browser network
+    traffic. The number of dashboards rendering at once follows AIMD: it grows
+    by one after a healthy window of queries and is halved when the window is
+    too slow or has too many errors. Card queries are also spaced to stay
+    under a global requests-per-second ceiling.
+    """
+
+    def __init__(self, max_concurrency=1, min_concurrency=1, max_rps=0, latency_target=10.0,
+                 error_threshold=0.1, window=20):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.max_rps = max_rps  # 0 means no ceiling
+        self.latency_target = latency_target  # Seconds, 90th percentile of a window
+        self.error_threshold = error_threshold
+        self.window = window
+
+        self.concurrency = self.min_concurrency
+        self._active = 0
+        self._condition = asyncio.Condition()
+        self._rate_lock = asyncio.Lock()
+        self._next_request_time = 0.0
+        self._samples = deque(maxlen=window)
+        self._tasks = set()  # Pending notifications, referenced so they aren't garbage-collected
+
+        # Totals for the run summary
+        self.total_queries = 0
+        self.total_errors = 0
+        self.total_timed = 0  # Queries with a known latency
+        self.total_latency = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for a rendering slot under the current concurrency limit."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < self.concurrency)
+            self._active += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    async def throttle(self):
+        """Wait until a card query can be sent without exceeding the requests-per-second ceiling."""
+        if not self.max_rps:
+            return
+        async with self._rate_lock:
+            now = time.monotonic()
+            if self._next_request_time > now:
+                await asyncio.sleep(self._next_request_time - now)
+                now = time.monotonic()
+            self._next_request_time = max(now, self._next_request_time) + 1 / self.max_rps
+
+    def record(self, latency, error=False):
+        """Record a finished card query and adjust the concurrency limit at the end of each window.
+
+        A latency of None (unknown) only counts towards the error rate.
+        """
+        self.total_queries += 1
+        self.total_errors += int(error)
+        if latency is not None:
+            self.total_timed += 1
+            self.total_latency += latency
+        self._samples.append((latency, error))
+        if len(self._samples) < self.window:
+            return
+
+        latencies = sorted(latency for latency, _ in self._samples if latency is not None)
+        p90_latency = latencies[max(0, int(len(latencies) * 0.9) - 1)] if latencies else None
+        error_rate = sum(1 for _, error in self._samples if error) / len(self._samples)
+        self._samples.clear()
+
+        too_slow = p90_latency is not None and p90_latency > self.latency_target
+        if error_rate > self.error_threshold or too_slow:
+            new_concurrency = max(self.min_concurrency, self.concurrency // 2)
+            p90_text = f"{p90_latency:.1f}s" if p90_latency is not None else "n/a"
+            reason = f"p90 {p90_text}, errors {error_rate:.0%}"
+        else:
+            new_concurrency = min(self.max_concurrency, self.concurrency + 1)
+            reason = "healthy"
+        if new_concurrency != self.concurrency:
+            print(f"Load governor: concurrency {self.concurrency} -> {new_concurrency} ({reason})")
+            self.concurrency = new_concurrency
+            task = asyncio.ensure_future(self._notify())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    def summary(self):
+        """Return a one-line summary of the card queries seen during the run."""
+        if not self.total_queries:
+            return "Load governor: no card queries observed"
+        average = f"{self.total_latency / self.total_timed:.2f}s" if self.total_timed else "n/a"
+        return (f"Load governor: {self.total_queries} card queries, "
+                f"avg {average}, "
+                f"{self.total_errors} errors, final concurrency {self.concurrency}")
+
+
+# Chromium flags for headless report rendering. Playwright already disables extensions,
+# background networking and renderer backgrounding, only the GPU is left to turn off.
+CHROMIUM_REPORT_ARGS = [
+    '--disable-gpu',
+]
+
 
 class MetabaseAgent:
-    def __init__(self, metabase_url, username, password):
+    def __init__(self, metabase_url, username, password, vector_charts=False, governor=None,
+                 cache_dir=None, page_pool_size=0, image_store=None):
         self.metabase_url = metabase_url
         self.username = username
         self.password = password
+        self.vector_charts = vector_charts  # Embed chart cards as SVG instead of screenshots
+        self.governor = governor  # Optional LoadGovernor measuring and throttling card queries
+        self.image_store = image_store  # Optional ImageStore deduplicating card screenshots
         self.playwright = None
         self.browser = None
         self.context = None
         self.page = None
+        self.is_worker = False  # Workers share the browser context and only own their page
+
+        # Profile directory keeping Metabase's JS/CSS bundles in the disk cache between runs
+        self.cache_dir = cache_dir
+        # Pages created up front for workers, and returned to the pool when they're done
+        self.page_pool_size = page_pool_size
+        self.page_pool = []
+        self.timings = {}  # Startup timings in seconds, shared with workers
 
         # Define normal and large viewport sizes
         self.normal_viewport = {'width': 1280, 'height': 800}  # Normal viewport size
@@ -51,25 +393,120 @@ class MetabaseAgent:
 
     async def initialize(self):
         """Initialize Playwright"""
+        from playwright.async_api import async_playwright
+
+        start_time = time.perf_counter()
         self.playwright = await async_playwright().start()
-        self.browser = await self.playwright.chromium.launch(headless=True)
-        self.context = await self.browser.new_context()
+        if self.cache_dir:
+            # A persistent context is the only way to get an on-disk HTTP cache,
+            # the session itself is not reused: login() always starts logged out
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.context = await self.playwright.chromium.launch_persistent_context(
+                self.cache_dir, headless=True, args=CHROMIUM_REPORT_ARGS)
+            await self.context.clear_cookies()
+            self.page = self.context.pages[0] if self.context.pages else await self.context.new_page()
+        else:
+            self.browser = await self.playwright.chromium.launch(headless=True, args=CHROMIUM_REPORT_ARGS)
+            self.context = await self.browser.new_context()
 
-        # Create a new page after creating the context
-        self.page = await self.context.new_page()
+            # Create a new page after creating the context
+            self.page = await self.context.new_page()
 
         # Set the initial viewport size to the normal size
         await self.page.set_viewport_size(self.normal_viewport)
 
-        # Additional setup (if any)
-        await self.context.route('**/*', self._handle_route)
+        for _ in range(self.page_pool_size):
+            page = await self.context.new_page()
+            await page.set_viewport_size(self.normal_viewport)
+            self.page_pool.append(page)
+
+        # Routing disables the HTTP cache, only intercept requests when card queries are throttled
+        if self.governor and self.governor.max_rps:
+            if self.cache_dir:
+                print("Warning: MAX_REQUESTS_PER_SECOND intercepts requests, which disables the browser cache")
+            await self.context.route(CARD_QUERY_PATTERN, self._handle_route)
+        if self.governor:
+            self.context.on('requestfinished', self._on_request_finished)
+            self.context.on('requestfailed', self._on_request_failed)
+
+        self._record_timing('browser_start', time.perf_counter() - start_time)
+
+    def _record_timing(self, name, seconds):
+        """Record a startup timing, only the first measurement of each name is kept."""
+        if name not in self.timings:
+            self.timings[name] = seconds
+            print(f"Timing: {name} {seconds:.2f}s")
+
+    def timings_summary(self):
+        """Return the startup timings as a single line."""
+        return "Timings: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.timings.items())
+
+    async def new_worker(self):
+        """Return an agent sharing this logged-in browser context with its own page."""
+        worker = copy.copy(self)
+        worker.is_worker = True
+        if self.page_pool:
+            worker.page = self.page_pool.pop()
+        else:
+            worker.page = await self.context.new_page()
+            await worker.page.set_viewport_size(self.normal_viewport)
+        return worker
 
     async def _handle_route(self, route):
         """Handle route interception for capturing API data"""
+        if self.governor and self._is_card_query(route.request):
+            await self.governor.throttle()
         await route.continue_()
 
+    @staticmethod
+    def _is_card_query(request):
+        return request.method == 'POST' and CARD_QUERY_PATTERN.search(request.url) is not None
+
+    @staticmethod
+    def _request_latency(request):
+        """Seconds between sending a request and the end of its response, if known.
+
+        Card queries answer 202 right away and stream keepalives until the query
+        is done, so only the end of the response reflects the query time. Timings
+        are relative to the creation of the request, starting from requestStart
+        leaves out the time the request was held back by the throttle.
+        """
+        timing = request.timing
+        if timing and timing.get('requestStart', -1) >= 0 and timing.get('responseEnd', -1) >= 0:
+            return (timing['responseEnd'] - timing['requestStart']) / 1000
+        return None
+
+    @staticmethod
+    def _query_failed(body):
+        """Whether a card query response body reports a failed query."""
+        try:
+            result = json.loads(body)
+        except ValueError:
+            return True
+        if not isinstance(result, dict):
+            return False
+        return result.get('status') == 'failed' or (result.get('status') is None and 'error' in result)
+
+    async def _on_request_finished(self, request):
+        if not self._is_card_query(request):
+            return
+        try:
+            response = await request.response()
+            # Query errors come back inside a 202 body, not as an HTTP error
+            error = response is None or response.status >= 400 or self._query_failed(await response.body())
+        except Exception as e:
+            print(f"Could not read card query response: {str(e)}")
+            error = True
+        self.governor.record(self._request_latency(request), error=error)
+
+    def _on_request_failed(self, request):
+        # Queries aborted by a page reload or navigation say nothing about the server load
+        if self._is_card_query(request) and 'net::ERR_ABORTED' not in (request.failure or ''):
+            self.governor.record(self._request_latency(request), error=True)
+
     async def login(self):
         """Log in to Metabase"""
+        start_time = time.perf_counter()
         try:
             print(f"Navigating to {self.metabase_url}/auth/login")
             await self.page.goto(f"{self.metabase_url}/auth/login")
@@ -81,6 +518,7 @@ class MetabaseAgent:
             print("Waiting for navigation element")
             await self.page.wait_for_selector('.Nav', timeout=30000)
             print("Logged in successfully")
+            self._record_timing('login', time.perf_counter() - start_time)
 
             await self.page.screenshot(path="login_success.png")
             print("Saved login success screenshot")
@@ -150,23 +588,32 @@ class MetabaseAgent:
 
 
 
-    async def extract_table_data_to_xlsx(self, card, output_dir, card_id):
-        """Extract table data from a table card and save it to an Excel file with clickable first column."""
+    async def extract_table_data_to_xlsx(self, card, output_dir, card_id, card_title=None):
+        """Extract table data from a table card and save it to an Excel file with clickable first column.
+
+        Returns None for a table without rows. Errors, including a card where no
+        table can be read on the first page, are raised so that the card is retried.
+        """
+        import openpyxl
+        import openpyxl.styles
+        import openpyxl.utils
+
         try:
             # Before extracting data, set the larger viewport
             await self.page.set_viewport_size(self.large_viewport)
-          
-            # Try to extract the card title
-            card_title = await self.page.evaluate('''(card) => {
-                const titleEl = card.querySelector('[data-testid="legend-caption-title"]');
-                if (titleEl) return titleEl.textContent.trim();
-
-                const altTitleEl = card.querySelector('.Visualization-title') ||
-                                    card.querySelector('.CardVisualization-title') ||
-                                    card.querySelector('h3') ||
-                                    card.querySelector('.dashcard-title');
-                return altTitleEl ? altTitleEl.textContent.trim() : null;
-            }''', card)
+
+            # Try to extract the card title, unless the card inventory already looked for it ('' when it has none)
+            if card_title is None:
+                card_title = await self.page.evaluate('''(card) => {
+                    const titleEl = card.querySelector('[data-testid="legend-caption-title"]');
+                    if (titleEl) return titleEl.textContent.trim();
+
+                    const altTitleEl = card.querySelector('.Visualization-title') ||
+                                        card.querySelector('.CardVisualization-title') ||
+                                        card.querySelector('h3') ||
+                                        card.querySelector('.dashcard-title');
+                    return altTitleEl ? altTitleEl.textContent.trim() : null;
+                }''', card)
             
             # Fallback title if not found
             title = card_title if card_title else f"table_{card_id}"
@@ -181,13 +628,19 @@ class MetabaseAgent:
             # Start paginating through the table
             while True:
                 print(f"--- Processing page {current_page} ---")
-                table_data = await self.page.evaluate('''(card) => {
+                # Read the current page and the pagination state in the same round-trip
+                page_data = await self.page.evaluate('''(card) => {
+                    // Check if the card's pagination footer exists and next button exists and is NOT disabled
+                    const tableFooter = card.querySelector('[data-testid="TableFooter"]');
+                    const nextButton = card.querySelector('[aria-label="Page suivante"]');
+                    const hasMorePages = !!(tableFooter && nextButton && !nextButton.hasAttribute('disabled'));
+
                     let table = card.querySelector('table');
                     let headers = [];
                     let rows = [];
 
                     if (!table) {
-                        return null;
+                        return { table: null, hasMorePages };
                     }
 
                     headers = Array.from(table.querySelectorAll('th')).map(th => th.textContent.trim());
@@ -212,9 +665,12 @@ class MetabaseAgent:
                         return rowData;
                     }).filter(row => row.length > 0);
 
-                    return { headers, rows };
+                    return { table: { headers, rows }, hasMorePages };
                 }''', card)
 
+                table_data = page_data['table']
+                if table_data is None and current_page == 1:
+                    raise Exception(f"No table could be read in card {card_id}")
                 if table_data:
                     if not headers:
                         headers = table_data['headers']
@@ -227,22 +683,12 @@ class MetabaseAgent:
                 print(f"Total rows loaded so far: {current_row_count}")
 
                 # UPDATED PAGINATION DETECTION LOGIC
-                has_more_pages = await self.page.evaluate('''() => {
-                    // Check if pagination footer exists
-                    const tableFooter = document.querySelector('[data-testid="TableFooter"]');
-                    if (!tableFooter) return false;
-                    
-                    // Check if next button exists and is NOT disabled
-                    const nextButton = document.querySelector('[aria-label="Page suivante"]');
-                    return nextButton && !nextButton.hasAttribute('disabled');
-                }''')
-
-                if not has_more_pages:
+                if not page_data['hasMorePages']:
                     print("No more pages, ending extraction.")
                     total_pages = current_page
                     break
 
-                next_button = await self.page.query_selector('[aria-label="Page suivante"]:not([disabled])')
+                next_button = await card.query_selector('[aria-label="Page suivante"]:not([disabled])')
                 if next_button:
                     await next_button.click()
                     print(f"Clicked next page, waiting for table to update...")
@@ -255,9 +701,12 @@ class MetabaseAgent:
             print(f"Total pages processed: {total_pages}")
             print(f"Total rows extracted: {len(all_rows)}")
 
-            if headers and all_rows:
-                # Create a pandas DataFrame for easier data handling
-                # But now we need to separate the text and hyperlinks first
+            if all_rows:
+                # Tables rendered without <th> cells still get a header row
+                if not headers:
+                    headers = [f"Colonne {idx}" for idx in range(1, max(len(row) for row in all_rows) + 1)]
+
+                # Separate the text and hyperlinks first
                 processed_rows = []
                 hyperlinks = []
 
@@ -275,7 +724,6 @@ class MetabaseAgent:
                     processed_rows.append(processed_row)
                     hyperlinks.append(hyperlink)
 
-                df = pd.DataFrame(processed_rows, columns=headers)
                 xlsx_filename = f"{safe_title}.xlsx"
                 xlsx_file_path = os.path.join(output_dir, xlsx_filename)
 
@@ -298,6 +746,11 @@ class MetabaseAgent:
                             cell_obj.hyperlink = hyperlink
                             cell_obj.style = "Hyperlink"  # Apply built-in hyperlink style
 
+                yellow_fill = solid_fill(YELLOW)
+                green_fill = solid_fill(GREEN)
+                red_fill = solid_fill(RED)
+                yellow_green_fill = solid_fill(YELLOW_GREEN)
+
                 # Color the "Nature Intervention" column (index is based on headers)
                 if "Nature Intervention" in headers:
                     nature_col_idx = headers.index("Nature Intervention") + 1
@@ -354,112 +807,419 @@ class MetabaseAgent:
         except Exception as e:
             print(f"Error extracting table data for card {card_id}: {str(e)}")
             traceback.print_exc()  # Print full traceback for better debugging
-            return None
+            raise
         finally:
             # Reset the viewport back to normal size after extraction
             await self.page.set_viewport_size(self.normal_viewport)
 
 
-    async def extract_dashboard_data(self, dashboard_url, output_dir):
-      """Extract data from the dashboard and export it as images and Excel files."""
-      os.makedirs(output_dir, exist_ok=True)
-
-      try:
-          # Navigate to dashboard
-          print(f"Navigating to dashboard URL: {dashboard_url}")
-          await self.page.goto(dashboard_url)
-          await self.wait_until_table_fully_loaded()
-          # Wait for the dashboard to load
-          print("Waiting for dashboard grid")
-        #   await self.page.wait_for_selector('[data-testid="dashboard-grid"]', timeout=30000)
-        #   print("Dashboard grid loaded")
-
-          # Add a longer wait to ensure all data loads
-          print("Waiting for data to fully load...")
-          await asyncio.sleep(30)  # Add a 5-second delay to allow tables to load
-
-          dashboard_title = await self.page.evaluate('''() => {
-              const titleElem = document.querySelector('.Dashboard-header .Entity-title');
-              return titleElem ? titleElem.textContent : 'Dashboard';
-          }''')
-          print(f"Dashboard title: {dashboard_title}")
-
-          dash_cards = await self.page.query_selector_all('.DashCard')
-          print(f"Found {len(dash_cards)} dashboard cards")
-
-          card_paths = []
-          is_table_card = []
-
-          for idx, card in enumerate(dash_cards):
-              card_id = idx + 1
-              print(f"Processing card {card_id}/{len(dash_cards)}")
-
-              # Wait for any loading indicators to disappear
-              try:
-                  # Check if this card has a loading spinner
-                  has_loading = await self.page.evaluate('''(card) => {
-                      return card.querySelector('.Loading-spinner') !== null ||
-                            card.querySelector('[data-testid="loading-spinner"]') !== null ||
-                            card.textContent.includes('Loading...');
-                  }''', card)
-
-                  if has_loading:
-                      print(f"Card {card_id} is still loading, waiting...")
-                      # Wait up to 30 seconds for loading to complete
-                      for _ in range(30):
-                          await asyncio.sleep(1)
-                          still_loading = await self.page.evaluate('''(card) => {
-                              return card.querySelector('.Loading-spinner') !== null ||
-                                    card.querySelector('[data-testid="loading-spinner"]') !== null ||
-                                    card.textContent.includes('Loading...');
-                          }''', card)
-                          if not still_loading:
-                              print(f"Card {card_id} finished loading")
-                              break
-              except Exception as e:
-                  print(f"Error checking loading state for card {card_id}: {str(e)}")
-
-              # Enhanced table detection - check for table cells even if the table element isn't directly found
-              is_table = await self.page.evaluate('''(card) => {
-                  // Try direct table detection first
-                  if (card.querySelector('table')) return true;
-
-                  // Check for table-like structures
-                  const hasTds = card.querySelectorAll('td').length > 0;
-                  const hasThs = card.querySelectorAll('th').length > 0;
-                  const hasTableRows = card.querySelectorAll('tr').length > 0;
-
-                  // If we have cells or rows, it's probably a table
-                  return (hasTds || hasThs || hasTableRows);
-              }''', card)
-
-              # Save this information for later use in PDF generation
-              is_table_card.append(is_table)
-
-              # Take screenshot of the card regardless of type
-              card_img_path = os.path.join(output_dir, f"card_{card_id}.png")
-              await card.screenshot(path=card_img_path)
-              print(f"Saved card {card_id} screenshot to {card_img_path}")
-              card_paths.append(card_img_path)
-
-              # If it's a table, extract to Excel
-              if is_table:
-                  print(f"Card {card_id} detected as a table, extracting data...")
-                  await self.extract_table_data_to_xlsx(card, output_dir, card_id)
-              else:
-                  print(f"Card {card_id} is not a table")
-
-          return card_paths, is_table_card
-
-      except Exception as e:
-          print(f"Error extracting dashboard data: {str(e)}")
-          error_path = os.path.join(output_dir, "error_state.png")
-          await self.page.screenshot(path=error_path)
-          print(f"Saved error state screenshot to {error_path}")
-          raise
+    async def get_card_inventory(self, indices=None):
+        """Describe dashboard cards in a single round-trip.
+
+        Returns one dict per `.DashCard` (or only for the given indices) with its
+        index, id, title, type ('table' or 'chart') and loading state. Pagination
+        is read with each table page by extract_table_data_to_xlsx.
+        """
+        return await self.page.evaluate('''(indices) => {
+            const cards = Array.from(document.querySelectorAll('.DashCard'));
+            const wanted = indices === null ? cards.map((_, idx) => idx) : indices;
+
+            return wanted.filter(idx => idx < cards.length).map(idx => {
+                const card = cards[idx];
+
+                const titleEl = card.querySelector('[data-testid="legend-caption-title"]') ||
+                                card.querySelector('.Visualization-title') ||
+                                card.querySelector('.CardVisualization-title') ||
+                                card.querySelector('h3') ||
+                                card.querySelector('.dashcard-title');
+
+                const loading = card.querySelector('.Loading-spinner') !== null ||
+                                card.querySelector('[data-testid="loading-spinner"]') !== null ||
+                                card.textContent.includes('Loading...');
+
+                // A card with a table, cells or rows is probably a table
+                const isTable = card.querySelector('table') !== null ||
+                                card.querySelectorAll('td, th, tr').length > 0;
+
+                return {
+                    index: idx,
+                    id: card.getAttribute('data-dashcard-key') || card.id || null,
+                    title: titleEl ? titleEl.textContent.trim() : null,
+                    type: isTable ? 'table' : 'chart',
+                    loading: loading
+                };
+            });
+        }''', indices)
+
+    async def wait_for_cards_loaded(self, inventory, timeout=30, check_interval=1):
+        """Wait for the inventoried cards to finish loading, refreshing only the cards that are still loading."""
+        start_time = time.time()
+        by_index = {info['index']: info for info in inventory}
+
+        while True:
+            loading = [idx for idx, info in by_index.items() if info['loading']]
+            if not loading:
+                return True
+            if time.time() - start_time >= timeout:
+                print(f"Cards still loading after {timeout}s: {[idx + 1 for idx in loading]}")
+                return False
+
+            print(f"Waiting for {len(loading)} loading card(s)...")
+            await asyncio.sleep(check_interval)
+            for info in await self.get_card_inventory(loading):
+                by_index[info['index']].update(info)
+                if not info['loading']:
+                    print(f"Card {info['index'] + 1} finished loading")
+
+    async def _process_card(self, card, card_id, output_dir, card_info):
+        """Take the screenshot of an inventoried card and export it to Excel if it is a table."""
+        # Wait up to 30 seconds for loading to complete
+        if card_info['loading']:
+            print(f"Card {card_id} is still loading, waiting...")
+            try:
+                await self.wait_for_cards_loaded([card_info])
+            except Exception as e:
+                print(f"Error checking loading state for card {card_id}: {str(e)}")
+
+        is_table = card_info['type'] == 'table'
+
+        # Prefer the vector chart, the screenshot is the fallback for non-SVG cards
+        card_svg_path = None
+        if self.vector_charts and not is_table:
+            card_svg_path = await self.extract_chart_svg(card, output_dir, card_id, card_info['title'])
+
+        card_img_path = None
+        if card_svg_path is None and self.image_store:
+            card_img_path = self.image_store.add(await card.screenshot())
+            print(f"Stored card {card_id} screenshot as {card_img_path}")
+        elif card_svg_path is None:
+            card_img_path = os.path.join(output_dir, f"card_{card_id}.png")
+            await card.screenshot(path=card_img_path)
+            print(f"Saved card {card_id} screenshot to {card_img_path}")
+
+        # If it's a table, extract to Excel
+        xlsx_path = None
+        if is_table:
+            print(f"Card {card_id} detected as a table, extracting data...")
+            # An empty title tells the export that the inventory found none, no need to look again
+            xlsx_path = await self.extract_table_data_to_xlsx(card, output_dir, card_id, card_info['title'] or '')
+        else:
+            print(f"Card {card_id} is not a table")
+
+        return {'status': 'done', 'screenshot': card_img_path, 'svg': card_svg_path,
+                'is_table': is_table, 'xlsx': xlsx_path}
+
+    async def extract_chart_svg(self, card, output_dir, card_id, title=None):
+        """Save the SVG markup of a chart card, returning its path or None if the card isn't drawn as SVG.
+
+        The card title and its HTML legend are drawn above the chart, as in the screenshot.
+        """
+        svg_markup = await self.page.evaluate('''([card, title]) => {
+            const ns = 'http://www.w3.org/2000/svg';
+
+            // The chart is the largest SVG of the card, smaller ones are icons
+            let chart = null;
+            let chartArea = 0;
+            for (const svg of card.querySelectorAll('svg')) {
+                const rect = svg.getBoundingClientRect();
+                if (rect.width * rect.height > chartArea) {
+                    chart = svg;
+                    chartArea = rect.width * rect.height;
+                }
+            }
+            if (!chart || chartArea < 2500) return null;
+
+            const rect = chart.getBoundingClientRect();
+            const clone = chart.cloneNode(true);
+
+            // Styles come from the app stylesheets, inline the ones that matter for rendering
+            const properties = ['fill', 'stroke', 'stroke-width', 'opacity', 'font-size', 'font-family', 'font-weight'];
+            const originals = chart.querySelectorAll('*');
+            const copies = clone.querySelectorAll('*');
+            const hidden = [];
+            originals.forEach((el, idx) => {
+                const style = window.getComputedStyle(el);
+                // Elements hidden by the stylesheets (tooltips, hover markers) would show up once inlined
+                if (style.display === 'none' || style.visibility === 'hidden') {
+                    hidden.push(copies[idx]);
+                    return;
+                }
+                for (const property of properties) {
+                    const value = style.getPropertyValue(property);
+                    if (value && !copies[idx].getAttribute(property)) {
+                        copies[idx].setAttribute(property, value);
+                    }
+                }
+            });
+            hidden.forEach(el => el.remove());
+
+            // HTML legend items, with the color of their dot
+            const legend = [];
+            for (const item of card.querySelectorAll('[data-testid="legend-item"], .LegendItem')) {
+                if (chart.contains(item)) continue;
+                const label = item.textContent.trim();
+                if (!label) continue;
+                let color = '#509ee3';
+                for (const el of [item, ...item.querySelectorAll('*')]) {
+                    const background = window.getComputedStyle(el).backgroundColor;
+                    if (background && background !== 'transparent' && background !== 'rgba(0, 0, 0, 0)') {
+                        color = background;
+                        break;
+                    }
+                }
+                legend.push({ label, color });
+            }
+
+            const text = (x, y, content, size, bold) => {
+                const el = document.createElementNS(ns, 'text');
+                el.setAttribute('x', x);
+                el.setAttribute('y', y);
+                el.setAttribute('font-family', 'Helvetica');
+                el.setAttribute('font-size', size);
+                el.setAttribute('fill', '#4c5773');
+                if (bold) el.setAttribute('font-weight', 'bold');
+                el.textContent = content;
+                return el;
+            };
+
+            const width = rect.width;
+            const root = document.createElementNS(ns, 'svg');
+            root.setAttribute('xmlns', ns);
+
+            // Header: title, then the legend wrapped in rows
+            let offset = 0;
+            if (title) {
+                root.appendChild(text(8, 17, title, 14, true));
+                offset = 24;
+            }
+            if (legend.length) {
+                let x = 8;
+                let row = 0;
+                for (const { label, color } of legend) {
+                    const itemWidth = 26 + label.length * 6.5;
+                    if (x + itemWidth > width && x > 8) {
+                        x = 8;
+                        row += 1;
+                    }
+                    const dot = document.createElementNS(ns, 'rect');
+                    dot.setAttribute('x', x);
+                    dot.setAttribute('y', offset + row * 18 + 4);
+                    dot.setAttribute('width', 10);
+                    dot.setAttribute('height', 10);
+                    dot.setAttribute('fill', color);
+                    root.appendChild(dot);
+                    root.appendChild(text(x + 14, offset + row * 18 + 13, label, 11, false));
+                    x += itemWidth;
+                }
+                offset += (row + 1) * 18 + 4;
+            }
+
+            // The chart is moved into a group rather than nested, svglib scales nested SVGs twice
+            const viewBox = chart.viewBox && chart.viewBox.baseVal;
+            const box = viewBox && viewBox.width && viewBox.height
+                ? viewBox : { x: 0, y: 0, width: rect.width, height: rect.height };
+            const group = document.createElementNS(ns, 'g');
+            group.setAttribute('transform',
+                `translate(0 ${offset}) scale(${rect.width / box.width} ${rect.height / box.height}) ` +
+                `translate(${-box.x} ${-box.y})`);
+            while (clone.firstChild) group.appendChild(clone.firstChild);
+            root.appendChild(group);
+
+            const height = offset + rect.height;
+            root.setAttribute('width', width);
+            root.setAttribute('height', height);
+            root.setAttribute('viewBox', `0 0 ${width} ${height}`);
+            return new XMLSerializer().serializeToString(root);
+        }''', [card, title])
+
+        if not svg_markup:
+            return None
+
+        card_svg_path = os.path.join(output_dir, f"card_{card_id}.svg")
+        with open(card_svg_path, 'w', encoding='utf-8') as file:
+            file.write(svg_markup)
+
+        # Only keep the SVG if ReportLab will be able to draw it
+        if load_svg_drawing(card_svg_path) is None:
+            print(f"Card {card_id} SVG can't be embedded, falling back to a screenshot")
+            os.remove(card_svg_path)
+            return None
+
+        print(f"Saved card {card_id} vector chart to {card_svg_path}")
+        return card_svg_path
+
+    async def _open_dashboard(self, dashboard_url):
+        """Navigate to a dashboard and wait until it has loaded."""
+        print(f"Navigating to dashboard URL: {dashboard_url}")
+        start_time = time.perf_counter()
+        await self.page.goto(dashboard_url)
+        if '/auth/login' in self.page.url:
+            raise Exception("Metabase session expired (redirected to the login page)")
+        await self.wait_until_table_fully_loaded()
+        self._record_timing('first_dashboard_load', time.perf_counter() - start_time)
+
+    async def _query_card(self, card_index):
+        """Return a fresh handle and inventory entry for one card, or (None, None) if it is gone."""
+        card = await self.page.query_selector(f'.DashCard >> nth={card_index}')
+        refreshed = await self.get_card_inventory([card_index])
+        return card, (refreshed[0] if refreshed else None)
+
+    async def _process_card_with_retry(self, dashboard_url, card, card_index, card_id, output_dir, retries, timeout,
+                                       backoff, card_info):
+        """Process a card with a time limit per attempt, retrying with exponential backoff.
+
+        Returns the manifest entry of the card and whether the dashboard was reloaded,
+        in which case the handles and inventory of the other cards are stale.
+        """
+        last_error = None
+        reloaded = False
+        for attempt in range(1, retries + 1):
+            try:
+                if attempt > 1:
+                    # A cancelled attempt can leave a table on any page, start again from a fresh dashboard
+                    reloaded = True
+                    await self._open_dashboard(dashboard_url)
+                    card, card_info = await self._query_card(card_index)
+                if card is None or card_info is None:
+                    raise Exception(f"Card {card_id} is no longer on the page")
+                entry = await asyncio.wait_for(
+                    self._process_card(card, card_id, output_dir, card_info), timeout=timeout)
+                return entry, reloaded
+            except Exception as e:
+                last_error = str(e) or type(e).__name__
+                print(f"Attempt {attempt}/{retries} failed for card {card_id}: {last_error}")
+                if attempt < retries:
+                    delay = backoff * 2 ** (attempt - 1)
+                    print(f"Retrying card {card_id} in {delay}s...")
+                    await asyncio.sleep(delay)
+
+        print(f"Giving up on card {card_id} after {retries} attempts")
+        return {'status': 'failed', 'error': last_error, 'attempts': retries}, reloaded
+
+    async def extract_dashboard_data(self, dashboard_url, output_dir, manifest=None,
+                                     card_retries=3, card_timeout=180, retry_backoff=5):
+        """Extract data from the dashboard and export it as images and Excel files.
+
+        Completed cards are recorded in the checkpoint manifest so that a re-run
+        only processes the cards that are still missing.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        if manifest is None:
+            manifest = load_manifest(output_dir, dashboard_url)
+
+        if manifest['card_count'] is not None and not manifest_failed_cards(manifest):
+            print(f"All {manifest['card_count']} cards already extracted, resuming from checkpoint")
+            return manifest_card_lists(manifest)
+
+        try:
+            # Navigate to dashboard
+            await self._open_dashboard(dashboard_url)
+            # Wait for the dashboard to load
+            print("Waiting for dashboard grid")
+            # await self.page.wait_for_selector('[data-testid="dashboard-grid"]', timeout=30000)
+            # print("Dashboard grid loaded")
+
+            # Add a longer wait to ensure all data loads
+            print("Waiting for data to fully load...")
+            await asyncio.sleep(30)  # Add a 5-second delay to allow tables to load
+
+            dashboard_title = await self.page.evaluate('''() => {
+                const titleElem = document.querySelector('.Dashboard-header .Entity-title');
+                return titleElem ? titleElem.textContent : 'Dashboard';
+            }''')
+            print(f"Dashboard title: {dashboard_title}")
+
+            dash_cards = await self.page.query_selector_all('.DashCard')
+            print(f"Found {len(dash_cards)} dashboard cards")
+
+            # Classify every card at once, then only poll the ones still loading
+            inventory = await self.get_card_inventory()
+            await self.wait_for_cards_loaded(inventory)
+
+            # The dashboard layout changed since the checkpoint, start over
+            if manifest['card_count'] not in (None, len(dash_cards)):
+                print(f"Card count changed ({manifest['card_count']} -> {len(dash_cards)}), discarding checkpoint")
+                manifest['cards'] = {}
+            manifest['card_count'] = len(dash_cards)
+            save_manifest(output_dir, manifest)
+
+            reloaded = False  # Set once a retry navigated again, the handles above are then stale
+            for idx in range(len(dash_cards)):
+                card_id = idx + 1
+                entry = manifest['cards'].get(str(card_id), {})
+                if manifest_card_done(entry):
+                    print(f"Card {card_id}/{len(dash_cards)} already extracted, skipping")
+                    continue
+
+                print(f"Processing card {card_id}/{len(dash_cards)}")
+                if reloaded:
+                    card, card_info = await self._query_card(idx)
+                else:
+                    card, card_info = dash_cards[idx], (inventory[idx] if idx < len(inventory) else None)
+                entry, card_reloaded = await self._process_card_with_retry(
+                    dashboard_url, card, idx, card_id, output_dir, card_retries, card_timeout, retry_backoff,
+                    card_info)
+                manifest['cards'][str(card_id)] = entry
+                reloaded = reloaded or card_reloaded
+
+                # A new card invalidates any report built from a previous attempt
+                manifest['pdf'] = None
+                save_manifest(output_dir, manifest)
+
+            return manifest_card_lists(manifest)
+
+        except Exception as e:
+            print(f"Error extracting dashboard data: {str(e)}")
+            error_path = os.path.join(output_dir, "error_state.png")
+            await self.page.screenshot(path=error_path)
+            print(f"Saved error state screenshot to {error_path}")
+            raise
+
+    def _browser_alive(self):
+        """Whether the browser and the main page are still usable."""
+        if self.context is None or self.page is None or self.page.is_closed():
+            return False
+        return self.browser is None or self.browser.is_connected()
+
+    async def ensure_ready(self):
+        """Make sure the browser is running and logged in, restarting it or logging in again if needed.
+
+        Used by long-running processes, where the browser can crash and the Metabase session expire.
+        """
+        if self._browser_alive():
+            try:
+                # The context's request API shares the browser cookies
+                response = await self.context.request.get(f"{self.metabase_url}/api/user/current")
+                if response.ok:
+                    return True
+                print(f"Metabase session expired (HTTP {response.status}), logging in again")
+                return await self.login()
+            except Exception as e:
+                print(f"Could not check the Metabase session: {str(e)}")
+
+        print("Browser is not usable anymore, restarting it")
+        try:
+            await self.close()
+        except Exception as e:
+            print(f"Error closing the previous browser: {str(e)}")
+        self.playwright = self.browser = self.context = self.page = None
+        # Pages of the previous browser are gone, workers still holding them use the old pool
+        self.page_pool = []
+        await self.initialize()
+        return await self.login()
 
     async def close(self):
         """Clean up resources"""
+        if self.is_worker:
+            if self.page.is_closed():
+                return
+            # Give the page back to the pool for the next worker
+            if len(self.page_pool) < self.page_pool_size:
+                await self.page.set_viewport_size(self.normal_viewport)
+                self.page_pool.append(self.page)
+            else:
+                await self.page.close()
+            return
         print("Closing Playwright resources")
         if self.context:
             await self.context.close()
@@ -471,8 +1231,16 @@ class MetabaseAgent:
 
 
 
-def generate_dashboard_pdf(card_paths, is_table_card, output_pdf_path):
-    """Generate PDF with a simpler layout as requested, including pagination."""
+def generate_dashboard_pdf(card_paths, is_table_card, output_pdf_path, image_store=None):
+    """Generate PDF with a simpler layout as requested, including pagination.
+
+    With an image store, screenshots are drawn from downscaled copies cached across runs.
+    """
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.units import inch
+    from reportlab.graphics import renderPDF
+
     # --- First pass: Count pages ---
     # Filter out table cards
     non_table_cards = [(i, path) for i, (path, is_table) in enumerate(zip(card_paths, is_table_card)) if not is_table]
@@ -521,6 +1289,28 @@ def generate_dashboard_pdf(card_paths, is_table_card, output_pdf_path):
         c.setLineWidth(1)  # Thinner line for card borders
         c.rect(x, y, w, h)
     
+    # Function to draw a card image, as vector graphics for SVG charts
+    def draw_card_image(img_path, x, y, w, h, preserve_aspect_ratio=False):
+        if img_path.endswith('.svg'):
+            drawing = load_svg_drawing(img_path)
+            if drawing is not None:
+                scale_x = w / drawing.width
+                scale_y = h / drawing.height
+                if preserve_aspect_ratio:
+                    scale_x = scale_y = min(scale_x, scale_y)
+                # Center the drawing in its box, like drawImage does
+                c.saveState()
+                c.translate(x + (w - drawing.width * scale_x) / 2, y + (h - drawing.height * scale_y) / 2)
+                c.scale(scale_x, scale_y)
+                renderPDF.draw(drawing, c, 0, 0)
+                c.restoreState()
+            else:
+                print(f"Skipping card that can't be drawn: {img_path}")
+            return
+        if image_store:
+            img_path = image_store.resized(img_path, w, h)
+        c.drawImage(img_path, x, y, width=w, height=h, preserveAspectRatio=preserve_aspect_ratio)
+
     # Function to start a new page
     def new_page():
         nonlocal page_num
@@ -575,10 +1365,9 @@ def generate_dashboard_pdf(card_paths, is_table_card, output_pdf_path):
         # Draw the first 3 cards on the same row (start at index 1 since the title was removed)
         for i in range(1, min(4, len(card_paths))):  # Only up to 3 cards (start at index 1)
             img_path = card_paths[i]
-            if os.path.exists(img_path):
+            if img_path and os.path.exists(img_path):
                 x_position = margin + (i - 1) * (card_width + card_spacing)  # Space them out evenly
-                c.drawImage(img_path, x_position, y_position - card_height,
-                            width=card_width, height=card_height)
+                draw_card_image(img_path, x_position, y_position - card_height, card_width, card_height)
                 draw_card_border(x_position, y_position - card_height, card_width, card_height)
         
         y_position -= (card_height + card_spacing)  # Move down after the row
@@ -590,15 +1379,15 @@ def generate_dashboard_pdf(card_paths, is_table_card, output_pdf_path):
     card_height = 2.5 * inch
     
     for idx, (orig_idx, img_path) in enumerate(remaining_cards):
-        if os.path.exists(img_path):
+        if img_path and os.path.exists(img_path):
             # Calculate if we have space for at least one row (2 cards)
             if y_position - (card_height + card_spacing) < margin + footer_height:  # Reserve space for footer
                 y_position = new_page()
             
             # Position for 2 cards per row
             x = margin if idx % 2 == 0 else margin + card_width + card_spacing
-            c.drawImage(img_path, x, y_position - card_height,
-                        width=card_width, height=card_height, preserveAspectRatio=True)
+            draw_card_image(img_path, x, y_position - card_height, card_width, card_height,
+                            preserve_aspect_ratio=True)
             draw_card_border(x, y_position - card_height, card_width, card_height)
             
             # Move to next row after every second card or if it's the last card in an odd position
@@ -616,6 +1405,10 @@ def generate_dashboard_pdf(card_paths, is_table_card, output_pdf_path):
     print(f"PDF generated with pagination ({total_pages} pages): {output_pdf_path}")
 
 
+# Seconds before giving up on an unresponsive SMTP server
+SMTP_TIMEOUT = 60
+
+
 def get_email_content(fournisseur_name):
     today_date = datetime.now().strftime('%d/%m/%Y')
 
@@ -629,7 +1422,7 @@ def get_email_content(fournisseur_name):
     return subject, body, pdf_filename, excel_filename
 
 def send_report_email(pdf_path, xlsx_files, recipients, subject, fournisseur_name, body, smtp_server, smtp_port,
-                     sender_email, sender_password, use_tls=True):
+                     sender_email, sender_password, use_tls=True, missing_cards=None):
     """
     Send an email with PDF and Excel attachments
     """
@@ -637,6 +1430,12 @@ def send_report_email(pdf_path, xlsx_files, recipients, subject, fournisseur_nam
         # Generate email content using fournisseur_name
         subject, body, pdf_filename, excel_filename = get_email_content(fournisseur_name)
 
+        # Warn the recipients when the report is partial
+        if missing_cards:
+            subject = f"{subject} - PARTIEL"
+            missing = ', '.join(str(card_id) for card_id in missing_cards)
+            body += f"\n\nRapport partiel : {len(missing_cards)} carte(s) n'ont pas pu être extraites ({missing})."
+
         # Create message container
         msg = MIMEMultipart()
         msg['From'] = sender_email
@@ -669,7 +1468,7 @@ def send_report_email(pdf_path, xlsx_files, recipients, subject, fournisseur_nam
                     print(f"Attached Excel: {excel_filename}")
 
 
-        server = smtplib.SMTP(smtp_server, smtp_port)
+        server = smtplib.SMTP(smtp_server, smtp_port, timeout=SMTP_TIMEOUT)
         if use_tls:
             server.starttls()
         server.login(sender_email, sender_password)
@@ -685,23 +1484,72 @@ def send_report_email(pdf_path, xlsx_files, recipients, subject, fournisseur_nam
         print(f"Failed to send email: {str(e)}")
         return False
     
-async def process_dashboard(agent, dashboard_url, dashboard_name, output_dir, email_config):
-    """Process a single dashboard and send its report via email"""
+async def process_dashboard(agent, dashboard_url, dashboard_name, output_dir, email_config, allow_partial=False,
+                            render=True, send_email=True, image_store=None):
+    """Process a single dashboard and send its report via email.
+
+    Progress is checkpointed in the dashboard manifest, a re-run resumes from
+    the first incomplete step (cards, PDF, email). Without an agent the cards
+    are taken from the checkpoint and the PDF is rebuilt. Returns the manifest.
+    """
     dashboard_output_dir = os.path.join(output_dir, dashboard_name)
     os.makedirs(dashboard_output_dir, exist_ok=True)
+    manifest = load_manifest(dashboard_output_dir, dashboard_url)
+
+    # Cards missing from the report already emailed today, a re-run retries them
+    delivered_missing = manifest['email_missing_cards'] if manifest['email_sent'] else None
+    if manifest['email_sent'] and send_email:
+        if not delivered_missing:
+            print(f"Report for {dashboard_name} already sent today, skipping")
+            return manifest
+        print(f"Partial report for {dashboard_name} already sent today, retrying missing cards {delivered_missing}")
 
     try:
-        print(f"Extracting data for {dashboard_name}")
-        card_paths, is_table_card = await agent.extract_dashboard_data(dashboard_url, dashboard_output_dir)
+        manifest['error'] = None
+        if agent is not None:
+            print(f"Extracting data for {dashboard_name}")
+            card_paths, is_table_card = await agent.extract_dashboard_data(
+                dashboard_url, dashboard_output_dir, manifest=manifest)
+        elif manifest['card_count'] is None:
+            print(f"No extracted cards for {dashboard_name} today, nothing to render")
+            return manifest
+        else:
+            print(f"Rendering {dashboard_name} from checkpoint")
+            card_paths, is_table_card = manifest_card_lists(manifest)
+            manifest['pdf'] = None
+
+        if not render:
+            return manifest
+
+        failed_cards = manifest_failed_cards(manifest)
+        if failed_cards:
+            print(f"{len(failed_cards)} card(s) failed for {dashboard_name}: {failed_cards}")
+            if not allow_partial:
+                print(f"Partial reports are disabled, not delivering {dashboard_name} (re-run to retry)")
+                return manifest
 
         # Generate PDF from extracted data (excluding tables)
-        print(f"Generating PDF for {dashboard_name}...")
         pdf_output_path = os.path.join(dashboard_output_dir, f"{dashboard_name}_report.pdf")
-        generate_dashboard_pdf(card_paths, is_table_card, pdf_output_path)
-        print(f"Dashboard PDF created at: {pdf_output_path}")
-
-        # Find all Excel files generated for this dashboard
-        xlsx_files = glob.glob(os.path.join(dashboard_output_dir, "*.xlsx"))
+        if manifest['pdf'] and os.path.exists(manifest['pdf']):
+            print(f"PDF for {dashboard_name} already built, resuming from checkpoint")
+        else:
+            print(f"Generating PDF for {dashboard_name}...")
+            # PDF and email work is blocking, keep it off the event loop shared with other dashboards
+            await asyncio.to_thread(generate_dashboard_pdf, card_paths, is_table_card, pdf_output_path,
+                                    image_store=image_store)
+            manifest['pdf'] = pdf_output_path
+            save_manifest(dashboard_output_dir, manifest)
+            print(f"Dashboard PDF created at: {pdf_output_path}")
+
+        if not send_email:
+            return manifest
+
+        if delivered_missing and len(failed_cards) >= len(delivered_missing):
+            print(f"No missing card recovered for {dashboard_name}, not sending the partial report again")
+            return manifest
+
+        # Excel files exported by the completed cards of this dashboard
+        xlsx_files = manifest_xlsx_files(manifest)
         print(f"Found {len(xlsx_files)} Excel files for {dashboard_name}")
 
         # Send email with the generated files
@@ -710,8 +1558,9 @@ async def process_dashboard(agent, dashboard_url, dashboard_name, output_dir, em
         subject = f"RAPPORT - {dashboard_name} ({today_date})"
         body = f"Veuillez trouver le rapport quotidien du {today_date}."
 
-        email_sent = send_report_email(
-            pdf_path=pdf_output_path,
+        email_sent = await asyncio.to_thread(
+            send_report_email,
+            pdf_path=manifest['pdf'],
             xlsx_files=xlsx_files,
             recipients=email_config['recipients'],
             subject=subject,
@@ -720,111 +1569,527 @@ async def process_dashboard(agent, dashboard_url, dashboard_name, output_dir, em
             smtp_server=email_config['smtp_server'],
             smtp_port=email_config['smtp_port'],
             sender_email=email_config['sender_email'],
-            sender_password=email_config['sender_password']
+            sender_password=email_config['sender_password'],
+            missing_cards=failed_cards
         )
 
         if email_sent:
+            manifest['email_sent'] = True
+            manifest['email_missing_cards'] = failed_cards
+            save_manifest(dashboard_output_dir, manifest)
             print(f"Email sent successfully for {dashboard_name}")
         else:
             print(f"Failed to send email for {dashboard_name}")
 
     except Exception as e:
         print(f"Error processing {dashboard_name}: {str(e)}")
+        manifest['error'] = str(e) or type(e).__name__
+        save_manifest(dashboard_output_dir, manifest)
 
+    return manifest
 
 
 
-# Load environment variables from .env file
-load_dotenv()
 
-async def run_all_dashboards():
+BASE_OUTPUT_DIR = "dashboard_exports"
+
+# Dashboards reported on, by name and Metabase path
+DASHBOARDS = [
+    {'name': 'PROTECH FM', 'path': '/dashboard/2-fournisseur-protech-fm'},
+    {'name': 'SOMEM', 'path': '/dashboard/10-fournisseur-somem?'},
+    {'name': 'PROCLIM', 'path': '/dashboard/4-fournisseur-proclim'},
+    {'name': 'SONOTRAB', 'path': '/dashboard/3-fournisseur-sonotrab'},
+]
 
-    METABASE_URL = os.getenv('METABASE_URL')
-    USERNAME = os.getenv('METABASE_USERNAME')
-    PASSWORD = os.getenv('METABASE_PASSWORD')
-    BASE_OUTPUT_DIR = "dashboard_exports"
 
+def env_flag(name, default='false'):
+    """Read a boolean setting from the environment."""
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes')
+
+
+def governor_from_env():
+    """Create the load governor from the environment settings."""
+    return LoadGovernor(
+        max_concurrency=int(os.getenv('MAX_CONCURRENT_DASHBOARDS') or 1),
+        max_rps=float(os.getenv('MAX_REQUESTS_PER_SECOND') or 0),
+        latency_target=float(os.getenv('QUERY_LATENCY_TARGET') or 10)
+    )
+
+
+def image_store_from_env():
+    """Create the screenshot store from the environment settings, or None if it is disabled."""
+    cache_dir = os.getenv('IMAGE_CACHE_DIR', '.image_cache')
+    if not cache_dir:
+        return None
+    return ImageStore(cache_dir, max_bytes=int(float(os.getenv('IMAGE_CACHE_MAX_MB') or 200) * 1024 * 1024))
+
+
+def agent_from_env(governor, vector_charts=False, image_store=None, mode='batch'):
+    """Create a MetabaseAgent from the environment settings.
+
+    Each mode ('batch', 'service') gets its own browser profile under BROWSER_CACHE_DIR,
+    Chromium locks a profile to a single process. Pages are only pooled when workers
+    are used: by the service, and by batch runs of several dashboards at once.
+    """
+    cache_dir = os.getenv('BROWSER_CACHE_DIR')
+    uses_workers = mode == 'service' or governor.max_concurrency > 1
+    return MetabaseAgent(
+        os.getenv('METABASE_URL'), os.getenv('METABASE_USERNAME'), os.getenv('METABASE_PASSWORD'),
+        vector_charts=vector_charts,
+        governor=governor,
+        cache_dir=os.path.join(cache_dir, mode) if cache_dir else None,
+        page_pool_size=int(os.getenv('PAGE_POOL_SIZE') or 0) if uses_workers else 0,
+        image_store=image_store
+    )
+
+
+def get_dashboards(names=None):
+    """Return the configuration of the selected dashboards (all of them by default)."""
+    METABASE_URL = os.getenv('METABASE_URL')
 
     EMAIL_BASE_CONFIG = {
         'smtp_server': os.getenv('SMTP_SERVER'),
-        'smtp_port': int(os.getenv('SMTP_PORT')),
+        'smtp_port': int(os.getenv('SMTP_PORT') or 587),
         'sender_email': os.getenv('SENDER_EMAIL'),
         'sender_password': os.getenv('SENDER_PASSWORD'),
+        'recipients': [r for r in (os.getenv('RECIPIENTS') or '').split(',') if r],
     }
 
     today_date = datetime.now().strftime('%d/%m/%Y')
 
-    # Define the three dashboards with their specific configurations
-    dashboards = [
-        {
-            'name': 'PROTECH FM',
-            'url': f"{METABASE_URL}/dashboard/2-fournisseur-protech-fm",
-            'email': {
-                **EMAIL_BASE_CONFIG,
-                'recipients': os.getenv('RECIPIENTS').split(','),
-                'subject': f"Fournisseur - PROTECH FM",
-                'body': f'Veuillez trouver le rapport quotidien du {today_date}.'
-            }
-        },
-         {
-            'name': 'SOMEM',
-            'url': f"{METABASE_URL}/dashboard/10-fournisseur-somem?",
-            'email': {
-                **EMAIL_BASE_CONFIG,
-                'recipients': os.getenv('RECIPIENTS').split(','),
-                'subject': f"Fournisseur - SOMEM ",
-                'body': f'Veuillez trouver le rapport quotidien du {today_date}.'
-            }
-         },
-        {
-            'name': 'PROCLIM',
-            'url': f"{METABASE_URL}/dashboard/4-fournisseur-proclim",
+    selected = [name.upper() for name in names] if names else None
+    dashboards = []
+    for dashboard in DASHBOARDS:
+        if selected is not None and dashboard['name'].upper() not in selected:
+            continue
+        dashboards.append({
+            'name': dashboard['name'],
+            'url': f"{METABASE_URL}{dashboard['path']}",
             'email': {
                 **EMAIL_BASE_CONFIG,
-                'recipients': os.getenv('RECIPIENTS').split(','),
-                'subject': f"Fournisseur - PROCLIM",
-                'body': f'Veuillez trouver le rapport quotidien du {today_date}.'
-            }
-        },
-        {
-            'name': 'SONOTRAB',
-            'url': f"{METABASE_URL}/dashboard/3-fournisseur-sonotrab",
-            'email': {
-                **EMAIL_BASE_CONFIG,
-                'recipients': os.getenv('RECIPIENTS').split(','),
-                'subject': f"Fournisseur - SONOTRAB",
+                'subject': f"Fournisseur - {dashboard['name']}",
                 'body': f'Veuillez trouver le rapport quotidien du {today_date}.'
             }
+        })
+    return dashboards
+
+
+async def run_all_dashboards(names=None, extract=True, render=True, send_email=True):
+    """Run the selected dashboards with a single logged-in agent."""
+    dashboards = get_dashboards(names)
+    if not dashboards:
+        print("No dashboard selected")
+        return
+
+    ALLOW_PARTIAL_REPORT = env_flag('ALLOW_PARTIAL_REPORT')
+    VECTOR_CHARTS = env_flag('VECTOR_CHARTS')
+
+    governor = governor_from_env()
+    image_store = image_store_from_env()
+
+    agent = None
+    if extract:
+        # Create and initialize agent only once
+        agent = agent_from_env(governor, vector_charts=VECTOR_CHARTS, image_store=image_store)
+        await agent.initialize()
+        login_success = await agent.login()
+
+        if not login_success:
+            print("Login failed, aborting all dashboards")
+            await agent.close()
+            return
+
+    async def run_dashboard(dashboard):
+        # The governor decides how many dashboards render at once, each on its own page
+        async with governor.slot():
+            worker = agent
+            if agent and governor.max_concurrency > 1:
+                worker = await agent.new_worker()
+            try:
+                print(f"\n--- Processing dashboard: {dashboard['name']} ---\n")
+                await process_dashboard(
+                    agent=worker,
+                    dashboard_url=dashboard['url'],
+                    dashboard_name=dashboard['name'],
+                    output_dir=BASE_OUTPUT_DIR,
+                    email_config=dashboard['email'],
+                    allow_partial=ALLOW_PARTIAL_REPORT,
+                    render=render,
+                    send_email=send_email,
+                    image_store=image_store
+                )
+            finally:
+                if worker is not agent:
+                    await worker.close()
+
+    try:
+        # Process all dashboards using the same logged-in agent
+        await asyncio.gather(*(run_dashboard(dashboard) for dashboard in dashboards))
+        if agent:
+            print(governor.summary())
+            print(agent.timings_summary())
+    finally:
+        # Close agent after all dashboards processed
+        if agent:
+            await agent.close()
+
+
+def describe_dashboards(names=None):
+    """Print what a run would do for the selected dashboards, without any side effect."""
+    for dashboard in get_dashboards(names):
+        dashboard_output_dir = os.path.join(BASE_OUTPUT_DIR, dashboard['name'])
+        manifest = load_manifest(dashboard_output_dir, dashboard['url'])
+        if manifest['email_sent'] and manifest['email_missing_cards']:
+            state = f"partial report sent, missing cards {manifest['email_missing_cards']}"
+        elif manifest['email_sent']:
+            state = "already sent today"
+        elif manifest['pdf']:
+            state = "PDF built, email pending"
+        elif manifest['card_count'] is not None:
+            missing = manifest_failed_cards(manifest)
+            state = f"{manifest['card_count'] - len(missing)}/{manifest['card_count']} cards extracted"
+        else:
+            state = "not started"
+        print(f"{dashboard['name']}: {dashboard['url']} ({state})")
+
+
+SERVICE_OUTPUT_DIR = os.path.join(BASE_OUTPUT_DIR, "service")
+
+
+def with_parameters(dashboard_url, parameters):
+    """Append Metabase filter parameters to a dashboard URL."""
+    if not parameters:
+        return dashboard_url
+    query = urlencode(sorted(parameters.items()))
+    if dashboard_url.endswith('?'):
+        return dashboard_url + query
+    return dashboard_url + ('&' if '?' in dashboard_url else '?') + query
+
+
+class ReportService:
+    """Render single dashboard reports on demand with a warm, logged-in agent.
+
+    Requests for the same dashboard, parameters and email flag are coalesced:
+    while a render is queued or running, or for `cache_ttl` seconds after it
+    succeeded, the same job is returned instead of starting a new render.
+    """
+
+    def __init__(self, agent, governor, output_dir=SERVICE_OUTPUT_DIR, cache_ttl=600, max_jobs=50,
+                 allow_partial=False):
+        self.agent = agent
+        self.governor = governor
+        self.output_dir = output_dir
+        self.cache_ttl = cache_ttl
+        self.max_jobs = max_jobs
+        self.allow_partial = allow_partial
+        self.jobs = {}  # Job id -> job, in submission order
+        self.jobs_by_key = {}  # Coalescing key -> latest job
+        self._tasks = set()  # Running job tasks, referenced so they aren't garbage-collected
+        self._agent_lock = asyncio.Lock()  # Only one job checks or restarts the shared agent at a time
+
+    async def submit(self, dashboard_name, parameters=None, send_email=False):
+        """Return the job rendering this report, starting one only if no equivalent job can be reused."""
+        dashboards = get_dashboards([dashboard_name])
+        if not dashboards:
+            raise KeyError(f"Unknown dashboard: {dashboard_name}")
+        dashboard = dashboards[0]
+        parameters = {str(k): str(v) for k, v in (parameters or {}).items()}
+        key = (dashboard['name'], tuple(sorted(parameters.items())), bool(send_email))
+
+        job = self.jobs_by_key.get(key)
+        if job and job['status'] in ('queued', 'running'):
+            print(f"Coalescing request for {dashboard['name']} into running job {job['id']}")
+            return job
+        if job and job['status'] == 'done' and time.time() - job['finished'] < self.cache_ttl:
+            print(f"Serving cached report {job['id']} for {dashboard['name']}")
+            return job
+
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            'id': job_id,
+            'dashboard': dashboard['name'],
+            'parameters': parameters,
+            'send_email': bool(send_email),
+            'url': with_parameters(dashboard['url'], parameters),
+            'email': dashboard['email'],
+            'output_dir': os.path.join(self.output_dir, job_id),
+            'status': 'queued',
+            'created': time.time(),
+            'finished': None,
+            'error': None,
+            'pdf': None,
+            'xlsx': [],
+            'email_sent': False,
+            'missing_cards': [],
         }
-    ]
+        self.jobs[job_id] = job
+        self.jobs_by_key[key] = job
+        self._evict()
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        print(f"Queued report {job_id} for {dashboard['name']}")
+        return job
+
+    async def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    async def _run(self, job):
+        try:
+            async with self.governor.slot():
+                job['status'] = 'running'
+                async with self._agent_lock:
+                    if not await self.agent.ensure_ready():
+                        raise Exception("Could not log in to Metabase")
+                worker = await self.agent.new_worker()
+                try:
+                    manifest = await process_dashboard(
+                        agent=worker,
+                        dashboard_url=job['url'],
+                        dashboard_name=job['dashboard'],
+                        output_dir=job['output_dir'],
+                        email_config=job['email'],
+                        allow_partial=self.allow_partial,
+                        send_email=job['send_email'],
+                        image_store=self.agent.image_store
+                    )
+                finally:
+                    await worker.close()
+
+            job['email_sent'] = manifest['email_sent']
+            job['missing_cards'] = manifest_failed_cards(manifest)
+            if manifest['pdf'] and os.path.exists(manifest['pdf']):
+                # The files stay downloadable, but an undelivered email is a failure and is never cached
+                job['pdf'] = manifest['pdf']
+                job['xlsx'] = manifest_xlsx_files(manifest)
+                if job['send_email'] and not manifest['email_sent']:
+                    job['status'] = 'failed'
+                    job['error'] = manifest.get('error') or "Report built but the email could not be sent"
+                else:
+                    job['status'] = 'done'
+            else:
+                job['status'] = 'failed'
+                job['error'] = manifest.get('error') or "Report was not produced, see the service logs"
+        except Exception as e:
+            job['status'] = 'failed'
+            job['error'] = str(e) or type(e).__name__
+        finally:
+            job['finished'] = time.time()
+            print(f"Report {job['id']} for {job['dashboard']}: {job['status']}")
+
+    def _evict(self):
+        """Forget the oldest finished jobs and their files beyond `max_jobs`."""
+        finished = [job for job in self.jobs.values() if job['status'] in ('done', 'failed')]
+        for job in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job['id']]
+            for key, latest in list(self.jobs_by_key.items()):
+                if latest is job:
+                    del self.jobs_by_key[key]
+            shutil.rmtree(job['output_dir'], ignore_errors=True)
+
+    @staticmethod
+    def describe(job):
+        """Public JSON view of a job, artifacts are referenced by their download path."""
+        files = [path for path in [job['pdf']] + job['xlsx'] if path]
+        return {
+            'id': job['id'],
+            'dashboard': job['dashboard'],
+            'parameters': job['parameters'],
+            'send_email': job['send_email'],
+            'status': job['status'],
+            'error': job['error'],
+            'email_sent': job['email_sent'],
+            'missing_cards': job['missing_cards'],
+            'created': datetime.fromtimestamp(job['created']).isoformat(timespec='seconds'),
+            'finished': datetime.fromtimestamp(job['finished']).isoformat(timespec='seconds')
+                        if job['finished'] else None,
+            'files': [f"/reports/{job['id']}/files/{os.path.basename(path)}" for path in files],
+        }
+
 
-   # Create and initialize agent only once
-    agent = MetabaseAgent(METABASE_URL, USERNAME, PASSWORD)
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    """HTTP API of the report service.
+
+    GET  /dashboards                        list the dashboards
+    POST /reports                           {"dashboard": "SOMEM", "parameters": {...}, "send_email": false}
+    GET  /reports/<id>                      job status
+    GET  /reports/<id>/files/<name>         download the PDF or an Excel file
+    """
+
+    # Seconds an HTTP thread waits for the event loop before answering 503
+    call_timeout = 30
+
+    def _call(self, coro):
+        # The service lives on the event loop, HTTP requests are served from other threads
+        future = asyncio.run_coroutine_threadsafe(coro, self.server.loop)
+        try:
+            return future.result(timeout=self.call_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = [part for part in urlparse(self.path).path.split('/') if part]
+
+        if parts == ['dashboards']:
+            self._send_json(200, [dashboard['name'] for dashboard in DASHBOARDS])
+            return
+
+        if len(parts) >= 2 and parts[0] == 'reports':
+            try:
+                job = self._call(self.server.service.get(parts[1]))
+            except concurrent.futures.TimeoutError:
+                self._send_json(503, {'error': "Service busy, try again later"})
+                return
+            if job is None:
+                self._send_json(404, {'error': f"Unknown report: {parts[1]}"})
+            elif len(parts) == 2:
+                self._send_json(200, ReportService.describe(job))
+            elif len(parts) == 4 and parts[2] == 'files':
+                self._send_file(job, parts[3])
+            else:
+                self._send_json(404, {'error': "Not found"})
+            return
+
+        self._send_json(404, {'error': "Not found"})
+
+    def _send_file(self, job, filename):
+        # Only the artifacts of the job can be downloaded
+        files = {os.path.basename(path): path for path in [job['pdf']] + job['xlsx'] if path}
+        path = files.get(filename)
+        if path is None or not os.path.exists(path):
+            self._send_json(404, {'error': f"Unknown file: {filename}"})
+            return
+
+        content_type = 'application/pdf' if path.endswith('.pdf') else \
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        with open(path, 'rb') as file:
+            data = file.read()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path.rstrip('/') != '/reports':
+            self._send_json(404, {'error': "Not found"})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}') if length else {}
+            # The query string can be used instead of a JSON body: /reports?dashboard=SOMEM
+            for name, values in parse_qs(parsed.query).items():
+                request.setdefault(name, values[0])
+            send_email = str(request.get('send_email', 'false')).lower() in ('1', 'true', 'yes')
+            job = self._call(self.server.service.submit(
+                request.get('dashboard', ''), request.get('parameters'), send_email))
+        except KeyError as e:
+            self._send_json(404, {'error': str(e.args[0])})
+            return
+        except concurrent.futures.TimeoutError:
+            self._send_json(503, {'error': "Service busy, try again later"})
+            return
+        except (ValueError, AttributeError) as e:
+            self._send_json(400, {'error': f"Invalid request: {str(e)}"})
+            return
+
+        self._send_json(202 if job['status'] in ('queued', 'running') else 200, ReportService.describe(job))
+
+
+async def serve_reports(host='127.0.0.1', port=8765):
+    """Run the on-demand report service until interrupted."""
+    governor = governor_from_env()
+
+    # A single warm agent, every report renders on its own page of the logged-in context
+    agent = agent_from_env(governor, vector_charts=env_flag('VECTOR_CHARTS'), image_store=image_store_from_env(),
+                           mode='service')
     await agent.initialize()
-    login_success = await agent.login()
+    if not await agent.login():
+        print("Login failed, not starting the report service")
+        await agent.close()
+        return
+
+    service = ReportService(agent, governor, cache_ttl=int(os.getenv('REPORT_CACHE_TTL') or 600),
+                            allow_partial=env_flag('ALLOW_PARTIAL_REPORT'))
+    server = ThreadingHTTPServer((host, port), ReportRequestHandler)
+    server.service = service
+    server.loop = asyncio.get_running_loop()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"Report service listening on http://{host}:{port}")
 
-    if not login_success:
-        print("Login failed, aborting all dashboards")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.shutdown()
+        print(governor.summary())
+        print(agent.timings_summary())
         await agent.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export Metabase dashboards to PDF/Excel reports and email them.")
+    parser.add_argument('-d', '--dashboard', action='append', dest='dashboards', metavar='NAME',
+                        help="Dashboard to process, can be repeated (default: all). "
+                             f"Choices: {', '.join(d['name'] for d in DASHBOARDS)}")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--extract-only', action='store_true',
+                      help="Only extract screenshots and Excel files, don't build the PDF or send emails")
+    mode.add_argument('--render-only', action='store_true',
+                      help="Rebuild the PDF from today's checkpoint without opening a browser or sending emails")
+    mode.add_argument('--dry-run', action='store_true',
+                      help="Show the selected dashboards and their checkpoint state, then exit")
+    mode.add_argument('--serve', action='store_true',
+                      help="Run the on-demand report service (HTTP API) with a warm browser")
+    parser.add_argument('--host', default='127.0.0.1', help="Report service address (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8765, help="Report service port (default: 8765)")
+    parser.add_argument('--no-email', action='store_true', help="Extract and render but don't send emails")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Load environment variables from .env file
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    print(f"Startup time: {(time.perf_counter() - _STARTUP_BEGIN) * 1000:.0f} ms")
+
+    if args.dry_run:
+        describe_dashboards(args.dashboards)
         return
 
-    # Process all dashboards using the same logged-in agent
-    for dashboard in dashboards:
-        print(f"\n--- Processing dashboard: {dashboard['name']} ---\n")
-        await process_dashboard(
-            agent=agent,
-            dashboard_url=dashboard['url'],
-            dashboard_name=dashboard['name'],
-            output_dir=BASE_OUTPUT_DIR,
-            email_config=dashboard['email']
-        )
+    if args.serve:
+        try:
+            asyncio.run(serve_reports(args.host, args.port))
+        except KeyboardInterrupt:
+            print("Report service stopped")
+        return
+
+    asyncio.run(run_all_dashboards(
+        names=args.dashboards,
+        extract=not args.render_only,
+        render=not args.extract_only,
+        send_email=not (args.extract_only or args.render_only or args.no_email)
+    ))
+
 
-    # Close agent after all dashboards processed
-    await agent.close()
+if __name__ == "__main__":
+    main()
 
-import nest_asyncio
-nest_asyncio.apply()
-asyncio.get_event_loop().run_until_complete(run_all_dashboards())
 # import asyncio
 # from aiocron import crontab
 
@@ -840,4 +2105,4 @@ asyncio.get_event_loop().run_until_complete(run_all_dashboards())
 #     print("Scheduler started - will run every 5 minutes")
 #     print("Press Ctrl+C to stop")
 #     asyncio.get_event_loop().run_forever()
-# # ===== End of added code =====
\ No newline at end of file
+# # ===== End of added code =====